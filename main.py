@@ -1,31 +1,127 @@
 import os
+import sys
+import csv
+import random
+import orjson
 import pandas as pd
 import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
+import atexit
 import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import queue
+import threading
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 
 # Load environment variables from a .env file (if present)
 load_dotenv()
 
-# Setup Logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("logs/app_debug.log"),
-        logging.StreamHandler()
-    ]
-)
-
 # Directories and file paths
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 OUTPUT_DIR = os.path.join(BASE_DIR, 'output')
+LOG_DIR = os.path.join(BASE_DIR, 'logs')
+LOG_FILE = os.path.join(LOG_DIR, 'app_debug.log')
 os.makedirs(OUTPUT_DIR, exist_ok=True)
+os.makedirs(LOG_DIR, exist_ok=True)
+
+# Setup Logging: file records are queued and written by a background listener thread, so worker
+# threads never block on disk I/O. Console output stays synchronous so messages appear before the
+# input() prompt that follows them.
+log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+# delay=True defers opening the file until the first record is written
+file_handler = RotatingFileHandler(LOG_FILE, maxBytes=50_000_000, backupCount=3, delay=True)
+file_handler.setFormatter(log_formatter)
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(log_formatter)
+
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(log_queue, file_handler)
+log_listener.start()
+atexit.register(log_listener.stop)  # Flush queued records on exit
+
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(QueueHandler(log_queue))
+root_logger.addHandler(stream_handler)
 
 # Configurations
 DATE_RANGE = ("2014-07-31", "2022-02-23")
 TEST_MODE = False  # Set this to True to limit to 20 companies for testing
+# ClearSpending does not publish a request quota. The default keeps the 5s spacing between requests
+# that each key had before the token bucket; raise it if your plan allows more. When responses carry
+# X-RateLimit-Remaining/X-RateLimit-Reset, a depleted quota also pauses that key until the reset.
+CLEARSPENDING_RATE = 0.2  # Sustained ClearSpending requests per second, per API key
+CLEARSPENDING_BURST = 1  # Requests allowed back-to-back per API key before throttling kicks in
+MAX_BACKOFF = 30 * 60  # Upper bound in seconds for the pause of a rate-limited API key
+MAX_KEY_RETRIES = 6  # 429 retries on one API key before its INN is handed to another key
+
+# Shared HTTP session: keeps connections alive and pools them across worker threads, and caches
+# successful responses on disk so re-runs skip the network. The API key is left out of the cache
+# key (and the stored request), so a page fetched with one key is a hit for every other key.
+# The adapter only retries transient 5xx errors with its own short backoff. It ignores Retry-After,
+# which urllib3 would otherwise obey for any 429/503, so all rate-limit pacing (and the MAX_BACKOFF
+# cap) stays in query_clearspending.
+SESSION = requests_cache.CachedSession(
+    os.path.join(OUTPUT_DIR, '.api_cache'),
+    backend='sqlite',
+    expire_after=timedelta(days=7),
+    allowable_methods=('GET',),
+    allowable_codes=(200,),
+    ignored_parameters=['apikey'],
+)
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504],
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    ),
+))
+
+
+class KeyRateLimited(Exception):
+    """Raised when an API key keeps getting 429 responses after MAX_KEY_RETRIES backoffs."""
+
+
+class TokenBucket:
+    """Thread-safe token bucket limiting how often requests are sent."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, stop=None):
+        """Block until a token is available and consume it; return False if stop is set first."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if stop is None:
+                time.sleep(wait)
+            elif stop.wait(wait):
+                return False
+
+    def defer(self, seconds):
+        """Empty the bucket and hold off refilling it for the given number of seconds."""
+        with self.lock:
+            self.tokens = 0
+            self.updated = max(self.updated, time.monotonic() + seconds)
 
 
 def is_valid_inn(number):
@@ -33,21 +129,30 @@ def is_valid_inn(number):
     return isinstance(number, str) and number.isdigit() and len(number) in [10, 12]
 
 
+def clean_list(values, lower=False):
+    """Strip entries and drop blanks and repeats (keeping first-seen order), optionally lowercasing."""
+    cleaned = (value.strip().lower() if lower else value.strip() for value in values)
+    return list(dict.fromkeys(value for value in cleaned if value))
+
+
 def get_api_keys():
-    """Retrieve API keys from environment variables or prompt user if not found."""
-    opensanctions_key = os.getenv("OPENSANCTIONS_API_KEY")
+    """Retrieve API keys from environment variables, prompting for missing ones on an interactive terminal."""
+    interactive = sys.stdin.isatty()
+    opensanctions_key = os.environ.get("OPENSANCTIONS_API_KEY")
     clearspending_keys = [
-        os.getenv(f"CLEARSPENDING_API_KEY_{i+1}") for i in range(9)
+        key for key in (os.environ.get(f"CLEARSPENDING_API_KEY_{i}") for i in range(1, 10)) if key
     ]
-    
-    if not opensanctions_key:
+
+    if not opensanctions_key and interactive:
         opensanctions_key = input("Enter your OpenSanctions API key: ")
-    
-    for i in range(9):
-        if not clearspending_keys[i]:
-            clearspending_keys[i] = input(f"Enter ClearSpending API key {i+1}: ")
-    
-    clearspending_keys = [key for key in clearspending_keys if key]
+
+    if not clearspending_keys and interactive:
+        clearspending_keys = [
+            key for key in (input(f"Enter ClearSpending API key {i}: ") for i in range(1, 10)) if key
+        ]
+
+    if not clearspending_keys:
+        raise SystemExit("No ClearSpending API keys found. Set CLEARSPENDING_API_KEY_1 ... CLEARSPENDING_API_KEY_9 in the environment or .env file.")
     return opensanctions_key, clearspending_keys
 
 
@@ -62,67 +167,95 @@ def setup_mode():
         TEST_MODE = False  # Disable test mode for INN-only searches
         logging.warning("Test mode is not available for INN-only search. Running in full mode.")
         inn_list = input("Enter INN numbers separated by commas: ").split(',')
-        inn_list = [inn.strip() for inn in inn_list if is_valid_inn(inn.strip())]
-        product_codes = input("Enter product codes (OKPD2) for filtering ClearSpending data (comma-separated): ").split(',')
+        inn_list = [inn for inn in clean_list(inn_list) if is_valid_inn(inn)]
+        product_codes = clean_list(input("Enter product codes (OKPD2) for filtering ClearSpending data (comma-separated): ").split(','))
         logging.info(f"Manual INN mode enabled with INNs: {inn_list} and OKPD2 filters: {product_codes}")
         return None, None, product_codes, inn_list
 
-    keywords = input("Enter keywords for search (comma-separated): ").split(',')
+    keywords = clean_list(input("Enter keywords for search (comma-separated): ").split(','))
     default_exclusions = ["banks", "politics", "medical"]
     user_exclusions = input(f"Enter keywords to exclude (default: {', '.join(default_exclusions)}): ")
-    excluded_keywords = user_exclusions.split(',') if user_exclusions else default_exclusions
+    excluded_keywords = clean_list(user_exclusions.split(','), lower=True) or default_exclusions
 
-    product_codes = input("Enter product codes (OKPD2) for filtering ClearSpending data (comma-separated): ").split(',')
+    product_codes = clean_list(input("Enter product codes (OKPD2) for filtering ClearSpending data (comma-separated): ").split(','))
     logging.info(f"Mode set to {'Test' if TEST_MODE else 'Full'} with keywords: {keywords} and exclusions: {excluded_keywords}")
     return keywords, excluded_keywords, product_codes, None
 
 
-def query_clearspending(inn, api_keys, page_size=50, start_date=DATE_RANGE[0], end_date=DATE_RANGE[1]):
-    """Query ClearSpending API for contracts based on INN."""
+def get_retry_after(response):
+    """Return the wait in seconds requested by the Retry-After header, or None if absent."""
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def get_rate_limit_reset(response):
+    """Return seconds until the quota resets if X-RateLimit-Remaining reports it used up, else None."""
+    if response.headers.get('X-RateLimit-Remaining') != '0':
+        return None
+    try:
+        reset = float(response.headers.get('X-RateLimit-Reset'))
+    except (TypeError, ValueError):
+        return None
+    if reset > 1e9:  # An epoch timestamp rather than a number of seconds
+        reset -= time.time()
+    return min(MAX_BACKOFF, max(0.0, reset))
+
+
+def query_clearspending(inn, api_key, bucket, stop, page_size=50, start_date=DATE_RANGE[0], end_date=DATE_RANGE[1]):
+    """Query ClearSpending API for contracts based on INN, using one API key throttled by its bucket.
+
+    Waits end early once the stop event is set, returning the contracts fetched so far.
+    Raises KeyRateLimited if the key is still rate limited after MAX_KEY_RETRIES backoffs.
+    """
     url = "https://newapi.clearspending.ru/csinternalapi/v1/filtered-contracts/"
     params = {
         'page_size': page_size,
         'sign_date_gte': start_date,
         'sign_date_lte': end_date,
         'customer_inn': inn,
+        'apikey': api_key,
     }
     all_contracts = []
     page = 1
-    key_index = 0
-    delay = 5
-    keys_exhausted = False
+    attempt = 0
 
     while True:
-        if keys_exhausted:
-            logging.warning("All keys exhausted. Waiting for 30 minutes...")
-            time.sleep(30 * 60)  # Wait 30 minutes before retrying
-            keys_exhausted = False
-
-        params['apikey'] = api_keys[key_index]
         params['page'] = page
 
         try:
-            time.sleep(delay)  # Incremental delay
-            response = requests.get(url, params=params)
+            response = SESSION.get(url, params=params, only_if_cached=True)
+            if response.status_code == 504:  # Not cached yet, so this page costs a rate-limited request
+                if not bucket.acquire(stop):
+                    break
+                response = SESSION.get(url, params=params)
+                reset = get_rate_limit_reset(response)
+                if reset:
+                    bucket.defer(reset)
 
             if response.status_code == 429:
-                logging.warning(f"Rate limit reached. Rotating keys and increasing delay to {delay + 1} seconds...")
-                delay += 1
-                key_index = (key_index + 1) % len(api_keys)
-                if key_index == 0:  # All keys exhausted
-                    keys_exhausted = True
+                if attempt == MAX_KEY_RETRIES:
+                    raise KeyRateLimited(f"API key still rate limited after {attempt} retries for INN {inn}")
+                # Pause this key until its quota refills; other keys keep working meanwhile.
+                # Jitter keeps lanes that were throttled together from retrying in lockstep.
+                backoff = min(MAX_BACKOFF, 0.5 * 2 ** attempt)
+                wait = min(MAX_BACKOFF, get_retry_after(response) or random.uniform(backoff / 2, backoff))
+                attempt += 1
+                logging.warning(f"Rate limit reached for INN {inn}. Pausing its API key for {wait:.1f} seconds...")
+                if stop.wait(wait):
+                    break
                 continue
 
+            attempt = 0
             response.raise_for_status()
-            data = response.json()
+            data = orjson.loads(response.content)
             all_contracts.extend(data.get('data', []))
             if not data.get('next_page'):
                 break
             page += 1
-            if delay > 5:  # Reduce delay slightly on successful requests
-                delay -= 1
 
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
             logging.error(f"Error querying ClearSpending API: {e}")
             break
 
@@ -131,43 +264,103 @@ def query_clearspending(inn, api_keys, page_size=50, start_date=DATE_RANGE[0], e
 
 def fetch_clearspending_data_from_inns(inn_list, output_file, api_keys, product_codes):
     """Fetch supplier data from ClearSpending API for a list of INN codes."""
-    suppliers_aggregate = []
-
-    for inn_code in inn_list:
-        logging.info(f"Querying ClearSpending for INN: {inn_code}")
-        contracts = query_clearspending(inn_code, api_keys)
-        if not contracts:
-            logging.info(f"No contracts found for INN: {inn_code}")
-            continue
-
-        # Filter and process contracts based on OKPD2 codes
-        for contract in contracts:
-            if any(product.startswith(okpd2.strip()) for product in contract.get('product_codes', []) for okpd2 in product_codes):
-                supplier_names = contract.get('supplier_names', [None])
-                supplier_name = supplier_names[0] if supplier_names else None  # Safely handle empty lists
-                supplier_inns = contract.get('supplier_inns', [None])
-                supplier_inn = supplier_inns[0] if supplier_inns else None  # Safely handle empty lists
-
-                contract_data = {
-                    'Supplier Name': supplier_name,
-                    'Supplier INN': supplier_inn,
-                    'Total Contract Value': contract.get('amount_rur', 0),
-                    'OKPD2 Codes': ', '.join(contract.get('product_codes', [])),
-                    'Customer Company Names': contract.get('customer_name', ''),
-                    'Customer Company INNs': inn_code,
-                }
-                suppliers_aggregate.append(contract_data)
-
-    # Save aggregated supplier data to CSV
-    output_df = pd.DataFrame(suppliers_aggregate)
-    if not output_df.empty:
-        output_df.to_csv(output_file, index=False)
+    fieldnames = [
+        'Supplier Name', 'Supplier INN', 'Total Contract Value', 'OKPD2 Codes',
+        'Customer Company Names', 'Customer Company INNs',
+    ]
+    rows_written = 0
+    # str.startswith() with a tuple checks every OKPD2 prefix in one C call; no codes means no filter
+    okpd2_prefixes = tuple(okpd2.strip() for okpd2 in product_codes) or ('',)
+
+    # Each API key is its own lane with its own rate limit. Pool entries are ordered by when the key
+    # may next be used, so a worker borrows the key that has been free longest; a key that stays
+    # rate limited is quarantined for MAX_BACKOFF and only lent out again once that has passed.
+    key_pool = queue.PriorityQueue()
+    for index, api_key in enumerate(api_keys):
+        key_pool.put((0.0, index, api_key, TokenBucket(CLEARSPENDING_RATE, CLEARSPENDING_BURST)))
+
+    # Set on error or Ctrl-C so workers abandon their waits instead of holding the process open
+    stop = threading.Event()
+
+    def query_one(inn_code):
+        tried_keys = set()  # Indexes of keys that hit KeyRateLimited for this INN
+        while not stop.is_set():
+            ready_at, index, api_key, bucket = key_pool.get()
+            quarantine = ready_at - time.monotonic()
+            if quarantine > 0:
+                # Every free key is quarantined; give it back and check again shortly in case
+                # another worker returns a healthy key first
+                key_pool.put((ready_at, index, api_key, bucket))
+                if len(tried_keys) == len(api_keys):
+                    logging.warning(f"All keys exhausted. Waiting up to {quarantine:.0f} seconds for INN {inn_code}...")
+                    tried_keys.clear()
+                stop.wait(min(quarantine, 1))
+                continue
+
+            ready_at = time.monotonic()
+            try:
+                logging.info(f"Querying ClearSpending for INN: {inn_code}")
+                return query_clearspending(inn_code, api_key, bucket, stop)
+            except KeyRateLimited as e:
+                # Pages fetched so far are cached, so restarting on another key does not re-spend quota
+                ready_at += MAX_BACKOFF
+                tried_keys.add(index)
+                logging.warning(f"{e}. Quarantining the key and moving INN {inn_code} to another key...")
+            finally:
+                key_pool.put((ready_at, index, api_key, bucket))
+        return []
+
+    # Queries are network-bound, so run one per key concurrently. Rows are written as soon as each
+    # INN completes, so an INN whose key is paused on a 429 does not hold back the others.
+    executor = ThreadPoolExecutor(max_workers=len(api_keys))
+    with open(output_file, 'w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+        writer.writeheader()
+
+        futures = {}
+        try:
+            futures = {executor.submit(query_one, inn_code): inn_code for inn_code in inn_list}
+            for future in as_completed(futures):
+                inn_code = futures.pop(future)  # Drop the reference so written results can be freed
+                contracts = future.result()
+                if not contracts:
+                    logging.info(f"No contracts found for INN: {inn_code}")
+                    continue
+
+                # Filter and process contracts based on OKPD2 codes
+                for contract in contracts:
+                    if any(product.startswith(okpd2_prefixes) for product in contract.get('product_codes', [])):
+                        supplier_names = contract.get('supplier_names', [None])
+                        supplier_name = supplier_names[0] if supplier_names else None  # Safely handle empty lists
+                        supplier_inns = contract.get('supplier_inns', [None])
+                        supplier_inn = supplier_inns[0] if supplier_inns else None  # Safely handle empty lists
+
+                        writer.writerow({
+                            'Supplier Name': supplier_name,
+                            'Supplier INN': supplier_inn,
+                            'Total Contract Value': contract.get('amount_rur', 0),
+                            'OKPD2 Codes': ', '.join(contract.get('product_codes', [])),
+                            'Customer Company Names': contract.get('customer_name', ''),
+                            'Customer Company INNs': inn_code,
+                        })
+                        rows_written += 1
+        except BaseException:
+            # Stop on errors and Ctrl-C without first querying every INN still queued
+            stop.set()
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+            raise
+        executor.shutdown()
+
+    if rows_written:
         logging.info(f"Supplier data saved to {output_file}")
     else:
         logging.info("No supplier data found.")
 
 
 def main():
+    SESSION.cache.delete(expired=True)  # Drop stale cached responses before a new run
     opensanctions_key, clearspending_keys = get_api_keys()
     keywords, excluded_keywords, product_codes, manual_inns = setup_mode()
 